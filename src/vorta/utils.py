@@ -6,16 +6,20 @@
 import os
 import platform
 import re
+import stat
 import sys
+import threading
 import unicodedata
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime as dt
-from functools import reduce
+from functools import lru_cache
 from typing import Any, Callable, Iterable, Optional, Tuple, TypeVar
 import psutil
 from paramiko import SSHException
 from paramiko.ecdsakey import ECDSAKey
 from paramiko.ed25519key import Ed25519Key
 from paramiko.rsakey import RSAKey
+from peewee import Case, Value, chunked
 from PyQt5 import QtCore
 from PyQt5.QtCore import QFileInfo, QThread, pyqtSignal
 from PyQt5.QtWidgets import QApplication, QFileDialog, QSystemTrayIcon
@@ -29,10 +33,15 @@
 
 borg_compat = BorgCompatibility()
 _network_status_monitor = None
+# Shared by all `get_directory_size` calls, so concurrent jobs (one per source)
+# don't each start their own threads on the same disk.
+_scan_executor = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4), thread_name_prefix='scan')
+# Number of directories a single scan task handles before handing the rest back.
+_SCAN_BATCH_SIZE = 64
 
 
 class FilePathInfoAsync(QThread):
-    signal = pyqtSignal(str, str, str)
+    signal = pyqtSignal(str, 'qlonglong', 'qlonglong')  # 64-bit, since sizes can exceed Qt's 32-bit int
 
     def __init__(self, path, exclude_patterns_str):
         self.path = path
@@ -42,12 +51,13 @@ def __init__(self, path, exclude_patterns_str):
         for _line in (exclude_patterns_str or '').splitlines():
             line = _line.strip()
             if line != '':
-                self.exclude_patterns.append(line)
+                self.exclude_patterns.append(prepare_pattern(line))
+        self._exclude_re = combine_patterns(self.exclude_patterns)
 
     def run(self):
         # logger.info("running thread to get path=%s...", self.path)
-        self.size, self.files_count = get_path_datasize(self.path, self.exclude_patterns)
-        self.signal.emit(self.path, str(self.size), str(self.files_count))
+        self.size, self.files_count = get_path_datasize(self.path, self._exclude_re)
+        self.signal.emit(self.path, self.size, self.files_count)
 
 
 def normalize_path(path):
@@ -57,21 +67,40 @@ def normalize_path(path):
     return unicodedata.normalize('NFD', path) if sys.platform == 'darwin' else path
 
 
+_SEP = os.path.sep
+_SEP_STAR = _SEP + '*'
+_SEP_STAR_SEP = _SEP_STAR + _SEP
+
+
 # prepare patterns as borg does
 # see `FnmatchPattern._prepare` at
 # https://github.com/borgbackup/borg/blob/master//src/borg/patterns.py
-def prepare_pattern(pattern):
-    """Prepare and process fnmatch patterns as borg does"""
-    if pattern.endswith(os.path.sep):
+@lru_cache(maxsize=512)
+def prepare_pattern(pattern: str) -> str:
+    """Prepare and process fnmatch patterns as borg does. Results are cached,
+    since profiles often share the same patterns."""
+    if pattern.endswith(_SEP):
         # trailing sep indicates that the contents should be excluded
         # but not the directory it self.
-        pattern = os.path.normpath(pattern).rstrip(os.path.sep)
-        pattern += os.path.sep + '*' + os.path.sep
+        pattern = os.path.normpath(pattern).rstrip(_SEP) + _SEP_STAR_SEP
     else:
-        pattern = os.path.normpath(pattern) + os.path.sep + '*'
+        pattern = os.path.normpath(pattern) + _SEP_STAR
+
+    # sep at beginning is removed, like it is for the matched paths
+    return fnmatch.translate(pattern.lstrip(_SEP))
 
-    pattern = pattern.lstrip(os.path.sep)  # sep at beginning is removed
-    return re.compile(fnmatch.translate(pattern))
+
+def combine_patterns(patterns: Iterable[str]) -> Optional[re.Pattern]:
+    """
+    Compile patterns prepared by `prepare_pattern` into a single regex
+    matching any of them. Returns `None` if there are no patterns.
+    """
+    # Drop duplicates: `prepare_pattern` returns the very same string for a repeated
+    # line, and on Python < 3.11 that string contains named groups which must be unique.
+    patterns = list(dict.fromkeys(patterns))
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{p})' for p in patterns))
 
 
 def match(pattern: re.Pattern, path: str):
@@ -80,51 +109,115 @@ def match(pattern: re.Pattern, path: str):
     return pattern.match(path) is not None
 
 
-def get_directory_size(dir_path, exclude_patterns):
-    '''Get number of files only and total size in bytes from a path.
-    Based off https://stackoverflow.com/a/17936789'''
-    exclude_patterns = [prepare_pattern(p) for p in exclude_patterns]
-
+def _scan_directory(dir_path, exclude_re, seen, seen_lock):
+    '''Get size and number of files directly inside a directory and list
+    its subdirectories which aren't excluded.'''
     data_size_filtered = 0
-    seen = set()
-    seen_filtered = set()
+    files_count_filtered = 0
+    subdirectories = []
 
-    for dir_path, subdirectories, file_names in os.walk(dir_path, topdown=True):
-        is_excluded = False
-        for pattern in exclude_patterns:
-            if match(pattern, dir_path):
-                is_excluded = True
+    # bind names used for every entry to locals, which are cheaper to look up
+    sep = os.path.sep
+    exclude_match = exclude_re.match if exclude_re is not None else None
+    # the normalization done by `match`, once for the whole directory
+    path_prefix = os.path.join(dir_path, '').lstrip(sep)
+    seen_add = seen.add
+    subdirectories_append = subdirectories.append
+
+    try:
+        entries = os.scandir(dir_path)
+    except OSError:
+        # like `os.walk`, skip directories that can't be listed
+        return data_size_filtered, files_count_filtered, subdirectories
+
+    with entries:
+        while True:
+            try:
+                entry = next(entries)
+            except StopIteration:
+                break
+            except OSError:
+                # like `os.walk`, stop listing a directory that fails while reading it
                 break
 
-        if is_excluded:
-            subdirectories.clear()  # so that os.walk won't walk them
-            continue
+            # Matching is pure CPU work, so check it before touching the filesystem.
+            if exclude_match is not None and exclude_match(f'{path_prefix}{entry.name}{sep}') is not None:
+                continue
 
-        for file_name in file_names:
-            file_path = os.path.join(dir_path, file_name)
+            # Errors of a single entry (e.g. removed while scanning) only skip that entry.
+            try:
+                # Ignore symbolic links, since borg doesn't follow them
+                if entry.is_symlink():
+                    continue
 
-            # Ignore symbolic links, since borg doesn't follow them
-            if os.path.islink(file_path):
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories_append(entry.path)
+                    continue
+
+                # the inode number is returned by `scandir` already, so hardlinks
+                # that were seen before are skipped without a stat call
+                inode = entry.inode()
+            except OSError:
                 continue
 
-            is_excluded = False
-            for pattern in exclude_patterns:
-                if match(pattern, file_path):
-                    is_excluded = True
-                    break
+            with seen_lock:
+                if inode in seen:  # Visit each file only once
+                    # this won't add the size of a hardlinked file
+                    continue
+                seen_add(inode)
 
             try:
-                stat = os.stat(file_path)
-                if stat.st_ino not in seen:  # Visit each file only once
-                    # this won't add the size of a hardlinked file
-                    seen.add(stat.st_ino)
-                    if not is_excluded:
-                        data_size_filtered += stat.st_size
-                        seen_filtered.add(stat.st_ino)
-            except (FileNotFoundError, PermissionError):
+                data_size_filtered += entry.stat(follow_symlinks=False).st_size
+                files_count_filtered += 1
+            except OSError:
                 continue
 
-    files_count_filtered = len(seen_filtered)
+    return data_size_filtered, files_count_filtered, subdirectories
+
+
+def _scan_directories(directories, exclude_re, seen, seen_lock):
+    '''Scan the given directories and their subdirectories, but at most `_SCAN_BATCH_SIZE`
+    directories. Returns size and number of files and the directories left to scan.'''
+    data_size_filtered = 0
+    files_count_filtered = 0
+    directories = list(directories)
+
+    for _ in range(_SCAN_BATCH_SIZE):
+        if not directories:
+            break
+        data_size, files_count, subdirectories = _scan_directory(directories.pop(), exclude_re, seen, seen_lock)
+        data_size_filtered += data_size
+        files_count_filtered += files_count
+        directories.extend(subdirectories)
+
+    return data_size_filtered, files_count_filtered, directories
+
+
+def get_directory_size(dir_path, exclude_re: Optional[re.Pattern]):
+    '''Get number of files only and total size in bytes from a path.
+    The exclude patterns must already be combined with `combine_patterns`.
+    Based off https://stackoverflow.com/a/17936789'''
+    if exclude_re is not None and match(exclude_re, dir_path):
+        return 0, 0
+
+    data_size_filtered = 0
+    files_count_filtered = 0
+    seen = set()
+    seen_lock = threading.Lock()
+
+    # Listing directories is bound by I/O latency, not CPU. The GIL is released
+    # during the syscalls, so scanning several subtrees at once overlaps the waits.
+    # Left over directories are handed back in batches, so flat trees don't need a task per directory.
+    pending = {_scan_executor.submit(_scan_directories, [dir_path], exclude_re, seen, seen_lock)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            data_size, files_count, directories = future.result()
+            data_size_filtered += data_size
+            files_count_filtered += files_count
+            for i in range(0, len(directories), _SCAN_BATCH_SIZE):
+                batch = directories[i : i + _SCAN_BATCH_SIZE]
+                pending.add(_scan_executor.submit(_scan_directories, batch, exclude_re, seen, seen_lock))
 
     return data_size_filtered, files_count_filtered
 
@@ -140,12 +233,12 @@ def get_network_status_monitor():
     return _network_status_monitor
 
 
-def get_path_datasize(path, exclude_patterns):
+def get_path_datasize(path, exclude_re):
     file_info = QFileInfo(path)
     data_size = 0
 
     if file_info.isDir():
-        data_size, files_count = get_directory_size(file_info.absoluteFilePath(), exclude_patterns)
+        data_size, files_count = get_directory_size(file_info.absoluteFilePath(), exclude_re)
         # logger.info("path (folder) %s %u elements size now=%u (%s)",
         #            file_info.absoluteFilePath(), files_count, data_size, pretty_bytes(data_size))
     else:
@@ -156,18 +249,10 @@ def get_path_datasize(path, exclude_patterns):
     return data_size, files_count
 
 
-def nested_dict():
-    """
-    Combination of two idioms to quickly build dicts from lists of keys:
-
-    - https://stackoverflow.com/a/16724937/3983708
-    - https://stackoverflow.com/a/14692747/3983708
-    """
-    return dict()
-
-
 def get_dict_from_list(dataDict, mapList):
-    return reduce(lambda d, k: d.setdefault(k, {}), mapList, dataDict)
+    for key in mapList:
+        dataDict = dataDict.setdefault(key, {})
+    return dataDict
 
 
 def choose_file_dialog(parent, title, want_folder=True):
@@ -179,66 +264,107 @@ def choose_file_dialog(parent, title, want_folder=True):
     return dialog
 
 
+# Key classes which can load a private key file, by the tag of its first BEGIN line.
+# Like paramiko (see `PKey.BEGIN_TAG`), the line may come after other text.
+# Files without such a line aren't tried at all.
+_PRIVATE_KEY_BEGIN_TAG = re.compile(rb'^-{5}BEGIN (RSA|EC|OPENSSH) PRIVATE KEY-{5}\s*$', re.MULTILINE)
+_PRIVATE_KEY_FORMATS = {
+    b'RSA': [RSAKey],
+    b'EC': [ECDSAKey],
+    b'OPENSSH': [RSAKey, ECDSAKey, Ed25519Key],
+}
+# Parsed keys by (path, mtime, size) of the key file. Files which couldn't be
+# read aren't cached, since fixing their permissions doesn't change mtime or size.
+_private_keys_cache = {}
+
+
+def _parse_private_key(key_file):
+    """Get the details of the private key(s) in a file. Returns `None` if the file can't be read."""
+    key = os.path.basename(key_file)
+    key_details = []
+    try:
+        with open(key_file, 'rb') as f:
+            begin_tag = _PRIVATE_KEY_BEGIN_TAG.search(f.read())
+        key_formats = _PRIVATE_KEY_FORMATS[begin_tag.group(1)] if begin_tag else []
+        for key_format in key_formats:
+            try:
+                parsed_key = key_format.from_private_key_file(key_file)
+                key_details.append(
+                    {
+                        'filename': key,
+                        'format': parsed_key.get_name(),
+                        'bits': parsed_key.get_bits(),
+                        'fingerprint': parsed_key.get_fingerprint().hex(),
+                    }
+                )
+            except (
+                SSHException,
+                UnicodeDecodeError,
+                IndexError,
+                ValueError,
+                NotImplementedError,
+            ):
+                logger.debug(f'Expected error parsing file in .ssh: {key} (You can safely ignore this)', exc_info=True)
+                continue
+    except (IsADirectoryError, PermissionError):
+        logger.debug(f'Expected error reading file in .ssh: {key} (You can safely ignore this)', exc_info=True)
+        return None
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            # when key_file is a (ControlPath) socket
+            return None
+        raise
+
+    return key_details
+
+
 def get_private_keys():
     """Find SSH keys in standard folder."""
-    key_formats = [RSAKey, ECDSAKey, Ed25519Key]
+    global _private_keys_cache
 
     ssh_folder = os.path.expanduser('~/.ssh')
 
     available_private_keys = []
+    private_keys_cache = {}
     if os.path.isdir(ssh_folder):
         for key in os.listdir(ssh_folder):
             key_file = os.path.join(ssh_folder, key)
-            if not os.path.isfile(key_file):
+            try:
+                key_stat = os.stat(key_file)
+            except OSError:
                 continue
-            for key_format in key_formats:
-                try:
-                    parsed_key = key_format.from_private_key_file(key_file)
-                    key_details = {
-                        'filename': key,
-                        'format': parsed_key.get_name(),
-                        'bits': parsed_key.get_bits(),
-                        'fingerprint': parsed_key.get_fingerprint().hex(),
-                    }
-                    available_private_keys.append(key_details)
-                except (
-                    SSHException,
-                    UnicodeDecodeError,
-                    IsADirectoryError,
-                    IndexError,
-                    ValueError,
-                    PermissionError,
-                    NotImplementedError,
-                ):
-                    logger.debug(
-                        f'Expected error parsing file in .ssh: {key} (You can safely ignore this)', exc_info=True
-                    )
+            if not stat.S_ISREG(key_stat.st_mode):
+                continue
+
+            # only parse new or changed files again
+            cache_key = (key_file, key_stat.st_mtime_ns, key_stat.st_size)
+            key_details = _private_keys_cache.get(cache_key)
+            if key_details is None:
+                key_details = _parse_private_key(key_file)
+                if key_details is None:
                     continue
-                except OSError as e:
-                    if e.errno == errno.ENXIO:
-                        # when key_file is a (ControlPath) socket
-                        continue
-                    else:
-                        raise
+            private_keys_cache[cache_key] = key_details
+            available_private_keys.extend(key_details)
 
+    # drop entries of removed or changed files
+    _private_keys_cache = private_keys_cache
     return available_private_keys
 
 
+_SIZE_UNIT_RANKS = {unit: rank for rank, unit in enumerate(['B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB'])}
+
+
 def sort_sizes(size_list):
     """Sorts sizes with extensions. Assumes that size is already in largest unit possible"""
-    final_list = []
-    for suffix in [" B", " KB", " MB", " GB", " TB", " PB", " EB", " ZB", " YB"]:
-        sub_list = [
-            float(size[: -len(suffix)])
-            for size in size_list
-            if size.endswith(suffix) and size[: -len(suffix)][-1].isnumeric()
-        ]
-        sub_list.sort()
-        final_list += [(str(size) + suffix) for size in sub_list]
-        # Skip additional loops
-        if len(final_list) == len(size_list):
-            break
-    return final_list
+    sizes = []
+    for size in size_list:
+        value, _, unit = size.rpartition(' ')
+        rank = _SIZE_UNIT_RANKS.get(unit)
+        if rank is None or not value[-1:].isnumeric():
+            continue
+        sizes.append((rank, float(value), size))
+    sizes.sort(key=lambda s: s[:2])
+    return [size for _, _, size in sizes]
 
 
 Number = TypeVar("Number", int, float)
@@ -292,13 +418,7 @@ def pretty_bytes(
         n = fixed_unit
     n = clamp(n, 0, len(units) - 1)
     size /= power**n
-    try:
-        unit = units[n]
-        digits = f'%.{precision}f' % (round(size, precision))
-        return f'{prefix}{digits} {unit}B'
-    except KeyError as error:
-        logger.error(error)
-        return "NaN"
+    return f'{prefix}{size:.{precision}f} {units[n]}B'
 
 
 def get_asset(path):
@@ -317,23 +437,57 @@ def get_sorted_wifis(profile):
     merge with networks from other profiles. Update last connected time.
     """
 
-    from vorta.store.models import WifiSettingModel
+    from vorta.store.models import DB, WifiSettingModel
 
     # Pull networks known to OS and all other backup profiles
     system_wifis = get_network_status_monitor().get_known_wifis()
-    from_other_profiles = WifiSettingModel.select().where(WifiSettingModel.profile != profile.id).execute()
+    from_other_profiles = (
+        WifiSettingModel.select(WifiSettingModel.ssid, WifiSettingModel.last_connected)
+        .where(WifiSettingModel.profile != profile.id)
+        .order_by(WifiSettingModel.id)
+        .tuples()
+    )
 
-    for wifi in list(from_other_profiles) + system_wifis:
-        db_wifi, created = WifiSettingModel.get_or_create(
-            ssid=wifi.ssid,
-            profile=profile.id,
-            defaults={'last_connected': wifi.last_connected, 'allowed': True},
-        )
+    # Last connected time by SSID, later networks take precedence
+    last_connected = dict(from_other_profiles)
+    last_connected.update((wifi.ssid, wifi.last_connected) for wifi in system_wifis)
+
+    # Existing networks of this profile. Like `get_or_create`, only the first row of an SSID is used.
+    profile_wifis = {}
+    for wifi_id, ssid, connected in (
+        WifiSettingModel.select(WifiSettingModel.id, WifiSettingModel.ssid, WifiSettingModel.last_connected)
+        .where(WifiSettingModel.profile == profile.id)
+        .order_by(WifiSettingModel.id)
+        .tuples()
+    ):
+        profile_wifis.setdefault(ssid, (wifi_id, connected))
+
+    new_wifis = [
+        {'ssid': ssid, 'last_connected': connected, 'allowed': True, 'profile': profile.id}
+        for ssid, connected in last_connected.items()
+        if ssid not in profile_wifis
+    ]
+    updated_wifis = {
+        profile_wifis[ssid][0]: connected
+        for ssid, connected in last_connected.items()
+        if ssid in profile_wifis and profile_wifis[ssid][1] != connected
+    }
+
+    with DB.atomic():
+        for batch in chunked(new_wifis, 100):
+            WifiSettingModel.insert_many(batch).execute()
 
         # Update last connected time
-        if not created and db_wifi.last_connected != wifi.last_connected:
-            db_wifi.last_connected = wifi.last_connected
-            db_wifi.save()
+        to_db = WifiSettingModel.last_connected.db_value
+        for batch in chunked(updated_wifis.items(), 100):
+            last_connected_case = Case(
+                WifiSettingModel.id,
+                [(wifi_id, Value(connected, converter=to_db)) for wifi_id, connected in batch],
+                WifiSettingModel.last_connected,
+            )
+            WifiSettingModel.update(last_connected=last_connected_case).where(
+                WifiSettingModel.id.in_([wifi_id for wifi_id, _ in batch])
+            ).execute()
 
     # Finally return list of networks and settings for that profile
     return (
@@ -362,6 +516,10 @@ def parse_args():
     return parser.parse_known_args()[0]
 
 
+_SLUG_STRIP = re.compile(r'[^\w\s-]')
+_SLUG_DASH = re.compile(r'[-\s]+')
+
+
 def slugify(value):
     """
     Converts to lowercase, removes non-word characters (alphanumerics and
@@ -370,9 +528,10 @@ def slugify(value):
 
     Copied from Django.
     """
-    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
-    value = re.sub(r'[^\w\s-]', '', value).strip().lower()
-    return re.sub(r'[-\s]+', '-', value)
+    if not value.isascii():  # ASCII is left unchanged by the normalization
+        value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
+    value = _SLUG_STRIP.sub('', value).strip().lower()
+    return _SLUG_DASH.sub('-', value)
 
 
 def uses_dark_mode():
@@ -399,22 +558,25 @@ def format_archive_name(profile, archive_name_tpl):
 
 
 SHELL_PATTERN_ELEMENT = re.compile(r'([?\[\]*])')
+_SHELL_PATTERN_CHARS = frozenset('?[]*')  # same characters, for cheap membership tests
 
 
 def get_mount_points(repo_url):
     mount_points = {}
     repo_mounts = []
-    for proc in psutil.process_iter():
+    # Only the name is fetched for all processes, the command line is read
+    # for possible borg processes only.
+    for proc in psutil.process_iter(attrs=['name'], ad_value=''):
         try:
-            name = proc.name()
+            name = proc.info['name']
             if name == 'borg' or name.startswith('python'):
-                if 'mount' not in proc.cmdline():
+                cmd = proc.cmdline()
+                if 'mount' not in cmd:
                     continue
 
                 if borg_compat.check('V2'):
                     # command line syntax:
                     # `borg mount -r <repo> <mountpoint> <path> (-a <archive_pattern>)`
-                    cmd = proc.cmdline()
                     if repo_url in cmd:
                         i = cmd.index(repo_url)
                         if len(cmd) > i + 1:
@@ -424,19 +586,19 @@ def get_mount_points(repo_url):
                             ao = '-a' in cmd
                             if ao or '--match-archives' in cmd:
                                 i = cmd.index('-a' if ao else '--match-archives')
-                                if len(cmd) >= i + 1 and not SHELL_PATTERN_ELEMENT.search(cmd[i + 1]):
+                                if len(cmd) >= i + 1 and _SHELL_PATTERN_CHARS.isdisjoint(cmd[i + 1]):
                                     mount_points[mount_point] = cmd[i + 1]
                             else:
                                 repo_mounts.append(mount_point)
                 else:
-                    for idx, parameter in enumerate(proc.cmdline()):
+                    for idx, parameter in enumerate(cmd):
                         if parameter.startswith(repo_url):
                             # mount from this repo
 
                             # The borg mount command specifies that the mount_point
                             # parameter comes after the archive name
-                            if len(proc.cmdline()) > idx + 1:
-                                mount_point = proc.cmdline()[idx + 1]
+                            if len(cmd) > idx + 1:
+                                mount_point = cmd[idx + 1]
 
                                 # archive or full mount?
                                 if parameter[len(repo_url) :].startswith('::'):
@@ -506,12 +668,13 @@ def search(key, iterable: Iterable, func: Callable = None) -> Tuple[int, Any]:
         The index and the item in case of a match else `None`.
     """
     if not func:
+        if isinstance(iterable, (list, tuple)):
+            # let the sequence compare the items in C
+            try:
+                i = iterable.index(key)
+            except ValueError:
+                return None
+            return i, iterable[i]
+        return next(((i, item) for i, item in enumerate(iterable) if item == key), None)
 
-        def func(x):
-            return x
-
-    for i, item in enumerate(iterable):
-        if func(item) == key:
-            return i, item
-
-    return None
+    return next(((i, item) for i, item in enumerate(iterable) if func(item) == key), None)
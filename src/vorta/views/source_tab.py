@@ -139,9 +139,6 @@ def set_path_info(self, path, data_size, files_count):
         self.sourceFilesWidget.setSortingEnabled(False)
 
         items = self.sourceFilesWidget.findItems(path, QtCore.Qt.MatchExactly)
-        # Conversion int->str->int needed because QT limits int to 32-bit
-        data_size = int(data_size)
-        files_count = int(files_count)
 
         for item in items:
             db_item = SourceFileModel.get(dir=path, profile=self.profile())
@@ -1,6 +1,26 @@
+import os
 import uuid
+from datetime import datetime as dt
+from datetime import timedelta
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from paramiko.rsakey import RSAKey
+import vorta.utils
 from vorta.keyring.abc import VortaKeyring
-from vorta.utils import find_best_unit_for_sizes, pretty_bytes
+from vorta.network_status.abc import SystemWifiInfo
+from vorta.store.models import BackupProfileModel, WifiSettingModel
+from vorta.utils import (
+    FilePathInfoAsync,
+    combine_patterns,
+    find_best_unit_for_sizes,
+    get_directory_size,
+    get_private_keys,
+    get_sorted_wifis,
+    prepare_pattern,
+    pretty_bytes,
+    sort_sizes,
+)
 
 
 def test_keyring():
@@ -79,3 +99,135 @@ def test_pretty_bytes_metric_nonfixed2():
 def test_pretty_bytes_metric_large():
     s = pretty_bytes(10**30, metric=True, precision=1)
     assert s == "1000000.0 YB"
+
+
+def test_sort_sizes():
+    sizes = ['1.5 GB', '20.0 KB', '3.0 B', '100.0 MB', '2.0 KB', 'Calculating…', '']
+    assert sort_sizes(sizes) == ['3.0 B', '2.0 KB', '20.0 KB', '100.0 MB', '1.5 GB']
+
+
+def test_combine_patterns_repeated():
+    exclude_re = combine_patterns(prepare_pattern(p) for p in ['*/node_modules', '*.pyc', '*/node_modules'])
+    assert exclude_re.match('home/user/project/node_modules/')
+    assert exclude_re.match('home/user/file.pyc/')
+    assert not exclude_re.match('home/user/file.py/')
+
+    exclude_re = combine_patterns(prepare_pattern(p) for p in ['/home/*/.cache/*/tmp', '*.log'] * 2)
+    assert exclude_re.match('home/user/.cache/app/tmp/')
+    assert not exclude_re.match('home/user/.cache/tmp/')
+
+
+def test_file_path_info_repeated_exclude_line():
+    thread = FilePathInfoAsync('/tmp', '*/node_modules\n*.pyc\n\n*/node_modules\n')
+    assert thread._exclude_re.match('tmp/project/node_modules/')
+
+
+def test_get_directory_size(tmp_path):
+    (tmp_path / 'a').write_bytes(b'x' * 10)
+    os.link(tmp_path / 'a', tmp_path / 'a_hardlink')  # counted once
+    os.symlink(tmp_path / 'a', tmp_path / 'a_symlink')  # not followed
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'b').write_bytes(b'x' * 20)
+    (tmp_path / 'excluded').mkdir()
+    (tmp_path / 'excluded' / 'c').write_bytes(b'x' * 40)
+
+    assert get_directory_size(str(tmp_path), None) == (70, 3)
+    assert get_directory_size(str(tmp_path), combine_patterns([prepare_pattern(str(tmp_path / 'excluded'))])) == (30, 2)
+    assert get_directory_size(str(tmp_path), combine_patterns([prepare_pattern(str(tmp_path))])) == (0, 0)
+
+    exclude_re = combine_patterns(prepare_pattern(str(tmp_path / d)) for d in ['excluded', 'sub'])
+    assert get_directory_size(str(tmp_path), exclude_re) == (10, 1)
+
+
+def test_get_private_keys_cache(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / '.ssh').mkdir()
+    key_file = tmp_path / '.ssh' / 'id_rsa'
+    RSAKey.generate(1024).write_private_key_file(str(key_file))
+    parse_spy = mocker.spy(vorta.utils, '_parse_private_key')
+
+    keys = get_private_keys()
+    assert [(k['filename'], k['bits']) for k in keys] == [('id_rsa', 1024)]
+    assert parse_spy.call_count == 1
+
+    # unchanged files are served from the cache
+    assert get_private_keys() == keys
+    assert parse_spy.call_count == 1
+
+    # changed files are parsed again
+    RSAKey.generate(2048).write_private_key_file(str(key_file))
+    assert [(k['filename'], k['bits']) for k in get_private_keys()] == [('id_rsa', 2048)]
+    assert parse_spy.call_count == 2
+
+    # entries of removed files are dropped
+    key_file.unlink()
+    assert get_private_keys() == []
+    assert vorta.utils._private_keys_cache == {}
+
+
+def test_get_private_keys_leading_text(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / '.ssh').mkdir()
+    key = rsa.generate_private_key(public_exponent=65537, key_size=1024).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH, serialization.NoEncryption()
+    )
+    # the BEGIN line doesn't have to be at the start of the file
+    (tmp_path / '.ssh' / 'id_rsa').write_bytes(b'Comment: exported key\nsecond line\n' + key)
+    (tmp_path / '.ssh' / 'known_hosts').write_text('example.com ssh-ed25519 AAAA\n')
+
+    assert [(k['filename'], k['format']) for k in get_private_keys()] == [('id_rsa', 'ssh-rsa')]
+
+
+@pytest.mark.skipif(os.geteuid() == 0, reason='root can read files without permission')
+def test_get_private_keys_unreadable(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / '.ssh').mkdir()
+    key_file = tmp_path / '.ssh' / 'id_rsa'
+    RSAKey.generate(1024).write_private_key_file(str(key_file))
+
+    key_file.chmod(0o000)
+    assert get_private_keys() == []
+
+    # fixing the permissions doesn't change mtime or size, the key must show up anyway
+    key_file.chmod(0o600)
+    assert [k['filename'] for k in get_private_keys()] == ['id_rsa']
+
+
+def test_get_sorted_wifis(mocker):
+    profile = BackupProfileModel.get(name='Default')
+    other_profile = BackupProfileModel.create(name='Other')
+    third_profile = BackupProfileModel.create(name='Third')
+    t = dt(2022, 1, 1, 12, 0, 0, 5)
+    day = timedelta(days=1)
+
+    WifiSettingModel.create(ssid='unchanged', last_connected=t, allowed=False, profile=profile)
+    WifiSettingModel.create(ssid='changed', last_connected=t, allowed=False, profile=profile)
+    WifiSettingModel.create(ssid='changed', last_connected=t, profile=profile)  # duplicate, left alone
+    WifiSettingModel.create(ssid='forgotten', last_connected=t, profile=profile)
+    WifiSettingModel.create(ssid='unchanged', last_connected=t, profile=other_profile)
+    WifiSettingModel.create(ssid='changed', last_connected=t + day, profile=other_profile)
+    WifiSettingModel.create(ssid='changed', last_connected=t + 2 * day, profile=third_profile)
+    WifiSettingModel.create(ssid='new', last_connected=t, profile=other_profile)
+    WifiSettingModel.create(ssid='forgotten', last_connected=t, profile=third_profile)
+
+    system_wifis = [
+        SystemWifiInfo(ssid='new', last_connected=t + 3 * day),
+        SystemWifiInfo(ssid='system', last_connected=t + 4 * day),
+        SystemWifiInfo(ssid='forgotten', last_connected=None),
+    ]
+    monitor = mocker.Mock()
+    monitor.get_known_wifis.return_value = system_wifis
+    mocker.patch('vorta.utils.get_network_status_monitor', return_value=monitor)
+
+    wifis = get_sorted_wifis(profile)
+
+    # the last occurrence (other profiles first, then system wifis) wins
+    assert [(w.ssid, w.last_connected, w.allowed) for w in wifis.order_by(WifiSettingModel.id)] == [
+        ('unchanged', t, False),
+        ('changed', t + 2 * day, False),
+        ('changed', t, True),
+        ('forgotten', None, True),
+        ('new', t + 3 * day, True),
+        ('system', t + 4 * day, True),
+    ]
+    assert [w.ssid for w in wifis][:2] == ['system', 'new']